@@ -14,37 +14,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import argparse
+import hashlib
+import json
 import logging
 import os
 import random
+import shutil
+import signal
 import sys
-from dataclasses import dataclass, field
+from contextlib import nullcontext
 from typing import Literal, Optional
 
 import torch
+import torch.utils.checkpoint
 import transformers
-from peft import PeftConfig, PeftModel
+from datasets import DatasetDict, load_from_disk
 from simpo_config import SimPOConfig
 from simpo_trainer import SimPOTrainer
-from transformers import AutoModelForCausalLM, set_seed
+from transformers import TrainerCallback, set_seed
+from transformers.integrations import is_deepspeed_zero3_enabled
+from transformers.utils import is_flash_attn_2_available
 
 from alignment import (
     DataArguments,
-    DPOConfig,
-    H4ArgumentParser,
     ModelArguments,
     get_checkpoint,
     get_datasets,
-    get_kbit_device_map,
     get_peft_config,
     get_quantization_config,
     get_tokenizer,
-    is_adapter_model,
 )
 from alignment.data import is_openai_format, maybe_insert_system_message
 
 logger = logging.getLogger(__name__)
 
+PROCESSED_CACHE_DIR = ".cache"
+# apply_chat_template / apply_chat_template_batched の整形処理を変更したら上げる（古いキャッシュを無効化）
+PROCESSED_FORMAT_VERSION = 1
+# SimPOTrainer.tokenize_row / build_tokenized_answer / tokenize_batch のトークナイズ処理を変更したら上げる
+TOKENIZED_FORMAT_VERSION = 1
+
 MISTRAL_CHAT_TEMPLATE = "{% if messages[0]['role'] == 'system' %}{% set loop_messages = messages[1:] %}{% set system_message = messages[0]['content'].strip() + '\n\n' %}{% else %}{% set loop_messages = messages %}{% set system_message = '' %}{% endif %}{% for message in loop_messages %}{% if loop.index0 == 0 %}{% set content = system_message + message['content'] %}{% else %}{% set content = message['content'] %}{% endif %}{% if message['role'] == 'user' %}{{ '[INST] ' + content.strip() + ' [/INST]' }}{% elif message['role'] == 'assistant' %}{{ ' '  + content.strip() + ' ' + eos_token }}{% endif %}{% endfor %}"
 
 
@@ -88,8 +97,11 @@ def apply_chat_template(
             )
     elif task == "simpo":
         if all(k in example.keys() for k in ("chosen", "rejected")):
-            if not is_openai_format(example["chosen"]) or not is_openai_format(
-                example["rejected"]
+            chosen, rejected = example["chosen"], example["rejected"]
+            if not (
+                isinstance(chosen, list)
+                and isinstance(rejected, list)
+                and is_openai_format(chosen + rejected)
             ):
                 raise ValueError(
                     f"Could not format example as dialogue for {task} task! Require OpenAI format for all messages"
@@ -99,35 +111,29 @@ def apply_chat_template(
             # We therefore need to extract the N-1 turns to form the prompt
             if "prompt" in example and is_openai_format(example["prompt"]):
                 prompt_messages = example["prompt"]
-                chosen_messages = example["chosen"]
-                rejected_messages = example["rejected"]
+                chosen_messages = chosen
+                rejected_messages = rejected
             else:
-                prompt_messages = example["chosen"][:-1]
+                prompt_messages = chosen[:-1]
                 # Now we extract the final turn to define chosen/rejected responses
-                chosen_messages = example["chosen"][-1:]
-                rejected_messages = example["rejected"][-1:]
+                chosen_messages = chosen[-1:]
+                rejected_messages = rejected[-1:]
 
             # Prepend a system message if the first message is not a system message
             if auto_insert_empty_system_msg:
                 maybe_insert_system_message(prompt_messages, tokenizer)
 
+            # chosen/rejected are appended to the prompt, so they must not start with a BOS token
+            bos_token = tokenizer.bos_token or ""
             example["text_prompt"] = tokenizer.apply_chat_template(
                 prompt_messages, tokenize=False
             )
             example["text_chosen"] = tokenizer.apply_chat_template(
                 chosen_messages, tokenize=False
-            )
-            if example["text_chosen"].startswith(tokenizer.bos_token):
-                example["text_chosen"] = example["text_chosen"][
-                    len(tokenizer.bos_token) :
-                ]
+            ).removeprefix(bos_token)
             example["text_rejected"] = tokenizer.apply_chat_template(
                 rejected_messages, tokenize=False
-            )
-            if example["text_rejected"].startswith(tokenizer.bos_token):
-                example["text_rejected"] = example["text_rejected"][
-                    len(tokenizer.bos_token) :
-                ]
+            ).removeprefix(bos_token)
         else:
             raise ValueError(
                 f"Could not format example as dialogue for {task} task! Require either the "
@@ -140,6 +146,236 @@ def apply_chat_template(
     return example
 
 
+def apply_chat_template_batched(
+    examples,
+    tokenizer,
+    task: Literal["rm", "simpo"],
+    auto_insert_empty_system_msg: bool = True,
+    change_template=None,
+):
+    """Batched version of `apply_chat_template` for the pairwise tasks, to be used with `.map(batched=True)`."""
+    if not all(k in examples.keys() for k in ("chosen", "rejected")):
+        raise ValueError(
+            f"Could not format examples as dialogue for {task} task! Require either the "
+            f"[chosen, rejected] or [prompt, chosen, rejected] keys but found {list(examples.keys())}"
+        )
+    num_examples = len(examples["chosen"])
+    prompts = examples["prompt"] if "prompt" in examples else [None] * num_examples
+
+    if task == "simpo":
+        outputs = {"text_prompt": [], "text_chosen": [], "text_rejected": []}
+    else:
+        outputs = {"text_chosen": [], "text_rejected": []}
+    for chosen, rejected, prompt in zip(examples["chosen"], examples["rejected"], prompts):
+        example = {"chosen": chosen, "rejected": rejected}
+        if prompt is not None:
+            example["prompt"] = prompt
+        example = apply_chat_template(
+            example,
+            tokenizer,
+            task=task,
+            auto_insert_empty_system_msg=auto_insert_empty_system_msg,
+            change_template=change_template,
+        )
+        for key, values in outputs.items():
+            values.append(example[key])
+    return outputs
+
+
+def compile_decoder_layers(model, mode: str = "default"):
+    """Compile the forward of each decoder layer with `torch.compile`.
+
+    Only the training forward is compiled; in eval mode the original eager forward is used so that
+    evaluation batches don't trigger extra recompiles.
+    """
+    for layer in model.get_decoder().layers:
+        eager_forward = layer.forward
+        compiled_forward = torch.compile(eager_forward, mode=mode, dynamic=False)
+
+        def forward(*args, _layer=layer, _eager=eager_forward, _compiled=compiled_forward, **kwargs):
+            if _layer.training:
+                return _compiled(*args, **kwargs)
+            return _eager(*args, **kwargs)
+
+        layer.forward = forward
+
+
+def checkpoint_decoder_layers(model, every: int = 2):
+    """Apply non-reentrant activation checkpointing to every `every`-th decoder layer.
+
+    The remaining layers keep their activations, trading a little memory for less recompute than
+    checkpointing every layer.
+    """
+    for index, layer in enumerate(model.get_decoder().layers):
+        if index % every != 0:
+            continue
+        layer_forward = layer.forward
+
+        def forward(*args, _layer=layer, _forward=layer_forward, **kwargs):
+            if _layer.training and torch.is_grad_enabled():
+                return torch.utils.checkpoint.checkpoint(
+                    _forward, *args, use_reentrant=False, **kwargs
+                )
+            return _forward(*args, **kwargs)
+
+        layer.forward = forward
+
+
+class SignalCheckpointCallback(TrainerCallback):
+    """Save a checkpoint and stop training at the next step boundary when the job receives SIGUSR1.
+
+    SIGUSR1 is meant to be sent by SLURM via `--signal=USR1@<seconds>` ahead of preemption or the time limit.
+    The signal handler only records the signal; at the end of each step the flag is all-reduced (MAX) over the
+    ranks so that every rank decides to save at the same step, even if the signal reached them at slightly
+    different times. SIGTERM is left to its default handler so that launchers can still tear down workers.
+    """
+
+    def __init__(self):
+        self.received_signal = False
+        self.stopped_by_signal = False
+        signal.signal(signal.SIGUSR1, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        self.received_signal = True
+
+    def on_step_end(self, args, state, control, **kwargs):
+        received_signal = torch.tensor(int(self.received_signal), device=args.device)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(received_signal, op=torch.distributed.ReduceOp.MAX)
+        if not received_signal.item():
+            return
+        logger.warning(f"Received SIGUSR1, saving a checkpoint at step {state.global_step} and stopping")
+        control.should_save = True
+        control.should_training_stop = True
+        self.stopped_by_signal = True
+
+
+def get_processed_cache_dir(
+    tokenizer,
+    data_args: DataArguments,
+    task: Literal["sft", "generation", "rm", "simpo"],
+    change_template=None,
+    max_train_samples: Optional[int] = None,
+    max_eval_samples: Optional[int] = None,
+    seed: Optional[int] = None,
+) -> str:
+    """Return the on-disk cache directory for the chat-template-formatted datasets.
+
+    The directory name is a hash of everything that affects the formatted text, so changing the
+    tokenizer, template, dataset mix or `PROCESSED_FORMAT_VERSION` results in a fresh cache.
+    """
+    cache_key = json.dumps(
+        [
+            PROCESSED_FORMAT_VERSION,
+            tokenizer.name_or_path,
+            tokenizer.chat_template,
+            MISTRAL_CHAT_TEMPLATE if change_template == "mistral" else None,
+            task,
+            data_args.dataset_mixer,
+            data_args.dataset_splits,
+            data_args.dataset_configs,
+            data_args.auto_insert_empty_system_msg,
+            max_train_samples,
+            max_eval_samples,
+            seed,
+        ],
+        sort_keys=True,
+    )
+    return os.path.join(
+        PROCESSED_CACHE_DIR,
+        f"{task}_{hashlib.sha256(cache_key.encode()).hexdigest()[:16]}",
+    )
+
+
+def get_tokenized_cache_dir(processed_cache_dir: str, training_args: SimPOConfig) -> str:
+    """Return the on-disk cache directory for the datasets tokenized by `SimPOTrainer`.
+
+    The directory name extends `processed_cache_dir` with a hash of the trainer settings that affect the
+    token ids and labels, so changing them or `TOKENIZED_FORMAT_VERSION` results in a fresh cache.
+    """
+    cache_key = json.dumps(
+        [
+            TOKENIZED_FORMAT_VERSION,
+            training_args.max_length,
+            training_args.max_prompt_length,
+            training_args.max_target_length,
+            training_args.truncation_mode,
+            training_args.label_pad_token_id,
+            training_args.is_encoder_decoder,
+        ],
+        sort_keys=True,
+    )
+    return f"{processed_cache_dir}_tokenized_{hashlib.sha256(cache_key.encode()).hexdigest()[:16]}"
+
+
+def save_to_disk_atomic(dataset_dict: DatasetDict, path: str):
+    """Save `dataset_dict` to `path` via a temporary directory, so an interrupted save never leaves a partial cache."""
+    if os.path.isdir(path):
+        return
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset_dict.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process has already moved its copy into place
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def build_simpo_datasets(
+    data_args: DataArguments,
+    tokenizer,
+    change_template=None,
+    max_train_samples: Optional[int] = None,
+    max_eval_samples: Optional[int] = None,
+):
+    """Load the raw preference datasets and format them as `prompt`/`chosen`/`rejected` text columns.
+
+    The splits are limited to `max_train_samples`/`max_eval_samples` before formatting so that the chat
+    template is only applied to the rows that are actually used.
+    """
+    # SimPOではprompt/chosen/rejectedのみ使用
+    columns_to_keep = ["chosen", "rejected", "prompt"]
+    raw_datasets = get_datasets(
+        data_args,
+        splits=data_args.dataset_splits,
+        configs=data_args.dataset_configs,
+        columns_to_keep=columns_to_keep,
+        # seed=training_args.seed,
+    )
+    for split, max_samples in (("train", max_train_samples), ("test", max_eval_samples)):
+        if max_samples is not None and len(raw_datasets[split]) > max_samples:
+            raw_datasets[split] = raw_datasets[split].select(range(max_samples))
+            logger.info(f"{split} dataset limited to {max_samples} samples")
+    column_names = list(raw_datasets["train"].features)
+
+    raw_datasets = raw_datasets.map(
+        apply_chat_template_batched,
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "task": "simpo",
+            "auto_insert_empty_system_msg": data_args.auto_insert_empty_system_msg,
+            "change_template": change_template,
+        },
+        batched=True,
+        batch_size=1000,
+        num_proc=data_args.preprocessing_num_workers,
+        remove_columns=column_names,
+        desc="Formatting comparisons with prompt template",
+    )
+
+    # Replace column names with what TRL needs, text_chosen -> chosen and text_rejected -> rejected
+    for split in ["train", "test"]:
+        raw_datasets[split] = raw_datasets[split].rename_columns(
+            {
+                "text_prompt": "prompt",
+                "text_chosen": "chosen",
+                "text_rejected": "rejected",
+            }
+        )
+    return raw_datasets
+
+
 def main():
     # DeepSpeed設定ファイルパスのみを受け取るカスタムパーサーを作成
     parser = argparse.ArgumentParser(add_help=False)
@@ -149,21 +385,62 @@ def main():
     parser.add_argument(
         "--local_rank", type=int, default=-1, help="Local rank for distributed training"
     )
+    parser.add_argument(
+        "--debug_samples",
+        action="store_true",
+        help="Log a formatted training sample on the local main process",
+    )
     custom_args, _ = parser.parse_known_args()
 
+    # attention以外のfp32 matmul（損失計算など）でTF32を使用
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
     # PYTORCH_CUDAのメモリ設定を改善
-    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "expandable_segments:True"
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = (
+        "expandable_segments:True,max_split_size_mb:512"
+    )
 
     # 最大シーケンス長を短くして、メモリ使用量を削減
     MAX_LENGTH = 192  # 元の設定は256
     MAX_PROMPT_LENGTH = 96  # 元の設定は128
 
+    # メモリ使用量を減らすためのデータセット制限（チャットテンプレート適用前に行う）
+    MAX_TRAIN_SAMPLES = 10000  # 例えば10000サンプルに制限
+    MAX_EVAL_SAMPLES = 1000  # 例えば1000サンプルに制限
+
+    # デコーダ層ごとにtorch.compileを適用（入力はMAX_LENGTHに固定パディングして再コンパイルを防ぐ）
+    # ZeRO-3（deepspeed 0.12はtorch.compile非対応）やFlashAttention-2（unpadでバッチごとに形状が変わる）とは併用不可
+    COMPILE_DECODER_LAYERS = False
+
+    # CHECKPOINT_EVERY層ごとにactivation checkpointingを適用（1の場合は全層をtransformers側で処理）
+    CHECKPOINT_EVERY = 2
+
+    # FlashAttention-2とネイティブbf16はAmpere（sm80）以降のGPUのみ対応
+    is_sm80_or_newer = (
+        torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+    )
+
+    # bf16はfp32と同じ指数部を持つためloss scalingが不要。非対応GPUのみfp16にフォールバック
+    # torch 2.2のis_bf16_supported()はエミュレーションでもTrueを返すためcompute capabilityで判定
+    use_bf16 = is_sm80_or_newer
+    if not use_bf16:
+        logger.warning("bf16 is not supported on this device, falling back to fp16")
+
+    # FlashAttention-2が使えない環境（未インストール、またはsm80未満）ではSDPAにフォールバック
+    attn_implementation = (
+        "flash_attention_2"
+        if is_flash_attn_2_available() and is_sm80_or_newer
+        else "sdpa"
+    )
+
     # YAMLの設定をハードコード
     # ModelArgumentsの設定
     model_args = ModelArguments(
         model_name_or_path="princeton-nlp/Llama-3-Base-8B-SFT",
-        torch_dtype=None,
-        attn_implementation="eager",
+        torch_dtype="bfloat16" if use_bf16 else "float16",  # FlashAttention-2はfp16/bf16のみ対応
+        attn_implementation=attn_implementation,
     )
 
     # DataArgumentsの設定
@@ -174,18 +451,28 @@ def main():
         auto_insert_empty_system_msg=True,
     )
 
+    # --deepspeed_configが指定されていればその値を使用し、指定がなければds_config.json（ZeRO-3）を使用
+    # TrainingArgumentsの__post_init__でDeepSpeedが初期化されるため、コンストラクタに渡す必要がある
+    deepspeed_config = custom_args.deepspeed_config or "ds_config.json"
+
+    # wandbへの記録はグローバルrank 0のみ行い、他のランクではwandbの初期化自体を行わない
+    is_rank_zero = int(os.environ.get("RANK", 0)) == 0
+    if not is_rank_zero:
+        os.environ["WANDB_MODE"] = "disabled"
+
     # SimPOConfigの設定
     training_args = SimPOConfig(
-        fp16=True,
+        deepspeed=deepspeed_config,
+        bf16=use_bf16,
+        fp16=not use_bf16,
         beta=2.0,
         gamma_beta_ratio=0.5,
         do_eval=True,
         evaluation_strategy="steps",
         eval_steps=400,
         gradient_accumulation_steps=16,
-        gradient_checkpointing=True,
+        gradient_checkpointing=CHECKPOINT_EVERY == 1,
         gradient_checkpointing_kwargs={"use_reentrant": False},
-        hub_model_id="simpo-exps",
         learning_rate=6.0e-7,
         log_level="info",
         logging_steps=5,
@@ -193,7 +480,8 @@ def main():
         max_length=MAX_LENGTH,  # 修正: シーケンス長を短く
         max_prompt_length=MAX_PROMPT_LENGTH,  # 修正: プロンプト長を短く
         num_train_epochs=1,
-        optim="adamw_torch",
+        # ZeRO-Offload時はds_config.jsonのoptimizer（DeepSpeedCPUAdam）が優先される
+        optim="adamw_torch_fused",
         output_dir="outputs/llama-3-8b-base-simpo",
         run_name="llama-3-8b-base-simpo",
         per_device_train_batch_size=1,
@@ -201,18 +489,36 @@ def main():
         push_to_hub=False,
         save_strategy="steps",
         save_steps=1000000,
-        report_to=["wandb"],
+        report_to=["wandb"] if is_rank_zero else [],
         save_total_limit=20,
         seed=42,
         warmup_ratio=0.1,
         remove_unused_columns=False,  # DPODataCollatorWithPaddingの警告を修正
+        # pinned memoryで非同期にGPUへ転送し、workerはepochをまたいで再利用
+        dataloader_num_workers=4,
+        dataloader_pin_memory=True,
+        dataloader_persistent_workers=True,
+        dataloader_prefetch_factor=4,
     )
 
-    # --deepspeed_configが指定されていればその値を使用し、指定がなければYAMLの値を使用
-    if custom_args.deepspeed_config:
-        training_args.deepspeed = custom_args.deepspeed_config
-    else:
-        training_args.deepspeed = "ds_config.json"
+    if COMPILE_DECODER_LAYERS:
+        if is_deepspeed_zero3_enabled():
+            raise ValueError(
+                "COMPILE_DECODER_LAYERS is not supported with DeepSpeed ZeRO-3, use a ZeRO-2 config or disable it"
+            )
+        if model_args.attn_implementation == "flash_attention_2":
+            raise ValueError(
+                "COMPILE_DECODER_LAYERS is not supported with flash_attention_2, whose unpadded inputs change shape every batch"
+            )
+        # 固定長パディングはコンパイル時のみ（再コンパイル防止）に使用
+        training_args.pad_to_max_length = True
+
+    # 長さの近いサンプルをまとめるとマイクロバッチ内のパディングが減る。ただしcollatorはマイクロバッチ単位で
+    # パディングするため、バッチサイズ1や固定長パディング時は効果がなく、サンプル順が偏るだけなので無効にする
+    training_args.group_by_length = (
+        training_args.per_device_train_batch_size > 1
+        and not training_args.pad_to_max_length
+    )
 
     # local_rankの設定
     if custom_args.local_rank >= 0:
@@ -245,94 +551,103 @@ def main():
     # Set seed for reproducibility
     set_seed(training_args.seed)
 
-    ###############
-    # Load datasets
-    ###############
-    raw_datasets = get_datasets(
-        data_args,
-        splits=data_args.dataset_splits,
-        configs=data_args.dataset_configs,
-        columns_to_keep=[
-            "messages",
-            "chosen",
-            "rejected",
-            "prompt",
-            "completion",
-            "label",
-        ],
-        # seed=training_args.seed,
-    )
-    logger.info(
-        f"Training on the following splits: {[split + ' : ' + str(dset.num_rows) for split, dset in raw_datasets.items()]}"
-    )
-    column_names = list(raw_datasets["train"].features)
-
-    #####################################
-    # Load tokenizer and process datasets
-    #####################################
+    ##################
+    # Load tokenizer
+    ##################
     data_args.truncation_side = (
         "left"  # Truncate from left to ensure we don't lose labels in final turn
     )
     tokenizer = get_tokenizer(model_args, data_args)
 
+    # Fast tokenizerはRust側でバッチを並列にエンコードできるため、SimPOTrainerのトークナイズは
+    # プロセスをforkせず1プロセスで行う。slow tokenizerの場合のみマルチプロセスにフォールバック
+    if tokenizer.is_fast:
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+        os.environ.setdefault(
+            "RAYON_NUM_THREADS", str(data_args.preprocessing_num_workers)
+        )
+        training_args.dataset_num_proc = None
+    else:
+        training_args.dataset_num_proc = data_args.preprocessing_num_workers
+
     if "mistral" in model_args.model_name_or_path.lower():
         change_template = "mistral"
     else:
         change_template = None
-    #####################
-    # Apply chat template
-    #####################
-    raw_datasets = raw_datasets.map(
-        apply_chat_template,
-        fn_kwargs={
-            "tokenizer": tokenizer,
-            "task": "simpo",
-            "auto_insert_empty_system_msg": data_args.auto_insert_empty_system_msg,
-            "change_template": change_template,
-        },
-        num_proc=data_args.preprocessing_num_workers,
-        remove_columns=column_names,
-        desc="Formatting comparisons with prompt template",
+
+    ##########################################
+    # Load datasets and apply chat template
+    ##########################################
+    # チャットテンプレート適用済みのデータセットをディスクにキャッシュし、2回目以降の前処理を省略
+    processed_cache_dir = get_processed_cache_dir(
+        tokenizer,
+        data_args,
+        task="simpo",
+        change_template=change_template,
+        max_train_samples=MAX_TRAIN_SAMPLES,
+        max_eval_samples=MAX_EVAL_SAMPLES,
+        seed=training_args.seed,
+    )
+    # SimPOTrainerでトークナイズ済みのデータセットもキャッシュし、2回目以降はトークナイズも省略
+    tokenized_cache_dir = get_tokenized_cache_dir(processed_cache_dir, training_args)
+    is_pretokenized = os.path.isdir(tokenized_cache_dir)
+    # マルチノードでも共有の.cacheに書き込むのはグローバルのメインプロセスのみ
+    with training_args.main_process_first(
+        local=False, desc="Preprocessing SimPO datasets"
+    ):
+        if is_pretokenized:
+            logger.info(f"Loading tokenized datasets from {tokenized_cache_dir}")
+            raw_datasets = load_from_disk(tokenized_cache_dir)
+        elif os.path.isdir(processed_cache_dir):
+            logger.info(f"Loading preprocessed datasets from {processed_cache_dir}")
+            raw_datasets = load_from_disk(processed_cache_dir)
+        else:
+            raw_datasets = build_simpo_datasets(
+                data_args,
+                tokenizer,
+                change_template=change_template,
+                max_train_samples=MAX_TRAIN_SAMPLES,
+                max_eval_samples=MAX_EVAL_SAMPLES,
+            )
+            save_to_disk_atomic(raw_datasets, processed_cache_dir)
+    logger.info(
+        f"Training on the following splits: {[split + ' : ' + str(dset.num_rows) for split, dset in raw_datasets.items()]}"
     )
 
-    # Replace column names with what TRL needs, text_chosen -> chosen and text_rejected -> rejected
-    for split in ["train", "test"]:
-        raw_datasets[split] = raw_datasets[split].rename_columns(
-            {
-                "text_prompt": "prompt",
-                "text_chosen": "chosen",
-                "text_rejected": "rejected",
-            }
+    # サンプルログは--debug_samples指定時のみ、ローカルのメインプロセスで出力（seedで選択を固定）
+    if custom_args.debug_samples and int(os.environ.get("LOCAL_RANK", 0)) == 0:
+        index = random.Random(training_args.seed).randrange(
+            min(len(raw_datasets["train"]), 100)
         )
-
-    # サンプルログを制限して無駄なメモリ使用を避ける
-    sample_indices = random.sample(range(min(len(raw_datasets["train"]), 100)), 1)
-    for index in sample_indices:
+        sample = raw_datasets["train"][index]
         logger.info(
-            f"Prompt sample {index} of the raw training set:\n\n{raw_datasets['train'][index]['prompt'][:200]}..."
+            f"Prompt sample {index} of the raw training set:\n\n{sample['prompt'][:200]}..."
         )
         logger.info(
-            f"Chosen sample {index} of the raw training set:\n\n{raw_datasets['train'][index]['chosen'][:200]}..."
+            f"Chosen sample {index} of the raw training set:\n\n{sample['chosen'][:200]}..."
         )
         logger.info(
-            f"Rejected sample {index} of the raw training set:\n\n{raw_datasets['train'][index]['rejected'][:200]}..."
+            f"Rejected sample {index} of the raw training set:\n\n{sample['rejected'][:200]}..."
         )
 
-    torch_dtype = (
-        model_args.torch_dtype
-        if model_args.torch_dtype in ["auto", None]
-        else getattr(torch, model_args.torch_dtype)
-    )
     quantization_config = get_quantization_config(model_args)
 
+    # device_map="auto"による層ごとのGPU分割は避け、各ランクのGPUにモデル全体を載せる
+    # ZeRO-3の場合はDeepSpeedがパラメータの配置を管理するためdevice_mapは指定しない
+    local_rank = int(
+        os.environ.get(
+            "LOCAL_RANK", custom_args.local_rank if custom_args.local_rank >= 0 else 0
+        )
+    )
+    device_map = None if is_deepspeed_zero3_enabled() else {"": local_rank}
+
+    # torch_dtypeは文字列のまま渡す（SimPOTrainer側でtorch.dtypeに変換される）
     model_kwargs = dict(
         revision=model_args.model_revision,
         trust_remote_code=model_args.trust_remote_code,
-        torch_dtype=torch_dtype,
+        torch_dtype=model_args.torch_dtype,
         use_cache=False,  # 常にキャッシュを無効化
-        device_map=(
-            "auto" if custom_args.local_rank < 0 else {"": custom_args.local_rank}
-        ),
+        device_map=device_map,
         quantization_config=quantization_config,
         attn_implementation=model_args.attn_implementation,
     )
@@ -340,19 +655,6 @@ def main():
     model = model_args.model_name_or_path
     training_args.model_init_kwargs = model_kwargs
 
-    # メモリ使用量を減らすためのデータセット制限（必要に応じて）
-    # トレーニングデータセットを制限
-    max_train_samples = 10000  # 例えば10000サンプルに制限
-    if len(raw_datasets["train"]) > max_train_samples:
-        raw_datasets["train"] = raw_datasets["train"].select(range(max_train_samples))
-        logger.info(f"Training dataset limited to {max_train_samples} samples")
-
-    # テストデータセットを制限
-    max_eval_samples = 1000  # 例えば1000サンプルに制限
-    if len(raw_datasets["test"]) > max_eval_samples:
-        raw_datasets["test"] = raw_datasets["test"].select(range(max_eval_samples))
-        logger.info(f"Evaluation dataset limited to {max_eval_samples} samples")
-
     #########################
     # Instantiate SimPO trainer
     #########################
@@ -364,9 +666,17 @@ def main():
         tokenizer=tokenizer,
         peft_config=get_peft_config(model_args),
     )
+    if not is_pretokenized and trainer.accelerator.is_main_process:
+        save_to_disk_atomic(
+            DatasetDict(train=trainer.train_dataset, test=trainer.eval_dataset),
+            tokenized_cache_dir,
+        )
 
-    # キャッシュをクリア
-    torch.cuda.empty_cache()
+    if COMPILE_DECODER_LAYERS:
+        torch._dynamo.config.cache_size_limit = 64
+        compile_decoder_layers(trainer.model)
+    if CHECKPOINT_EVERY > 1:
+        checkpoint_decoder_layers(trainer.model, every=CHECKPOINT_EVERY)
 
     ###############
     # Training loop
@@ -377,61 +687,68 @@ def main():
     elif last_checkpoint is not None:
         checkpoint = last_checkpoint
 
-    try:
+    # SLURMのプリエンプション（--signal=USR1@120）を受けたら次のステップ境界でチェックポイントを保存して終了
+    # OOMなどの例外は捕捉せずにそのまま落とし、スケジューラの時間を無駄にしない
+    signal_checkpoint_callback = SignalCheckpointCallback()
+    trainer.add_callback(signal_checkpoint_callback)
+
+    # SDPAの場合はmathカーネルを無効化し、flash/mem-efficientカーネルを強制
+    if model_args.attn_implementation == "sdpa":
+        sdpa_context = torch.backends.cuda.sdp_kernel(
+            enable_flash=True, enable_mem_efficient=True, enable_math=False
+        )
+    else:
+        sdpa_context = nullcontext()
+
+    with sdpa_context:
         train_result = trainer.train(resume_from_checkpoint=checkpoint)
-        metrics = train_result.metrics
-        metrics["train_samples"] = len(raw_datasets["train"])
-        trainer.log_metrics("train", metrics)
-        trainer.save_metrics("train", metrics)
-        trainer.save_state()
-
-        logger.info("*** Training complete ***")
-
-        ##################################
-        # Save model and create model card
-        ##################################
-        logger.info("*** Save model ***")
-        trainer.save_model(training_args.output_dir)
-        logger.info(f"Model saved to {training_args.output_dir}")
-
-        # Save everything else on main process
-        kwargs = {
-            "finetuned_from": model_args.model_name_or_path,
-            "dataset": list(data_args.dataset_mixer.keys()),
-            "dataset_tags": list(data_args.dataset_mixer.keys()),
-            "tags": ["alignment-handbook"],
-        }
-        if trainer.accelerator.is_main_process:
-            trainer.create_model_card(**kwargs)
-            # Restore k,v cache for fast inference
-            trainer.model.config.use_cache = True
-            trainer.model.config.save_pretrained(training_args.output_dir)
-
-        ##########
-        # Evaluate
-        ##########
-        if training_args.do_eval:
-            logger.info("*** Evaluate ***")
-            metrics = trainer.evaluate()
-            metrics["eval_samples"] = len(raw_datasets["test"])
-            trainer.log_metrics("eval", metrics)
-            trainer.save_metrics("eval", metrics)
-
-        if training_args.push_to_hub is True:
-            logger.info("Pushing to hub...")
-            trainer.push_to_hub(**kwargs)
-
-        logger.info("*** Training complete! ***")
-    except Exception as e:
-        logger.error(f"Training failed with error: {e}")
-        # エラーが発生した場合でも可能な限りモデルを保存
-        try:
-            if trainer.accelerator.is_main_process:
-                logger.info("Attempting to save partial model...")
-                trainer.save_model(training_args.output_dir + "_partial")
-        except:
-            logger.error("Failed to save partial model")
-        raise e
+    # シグナルで中断した場合はチェックポイント保存のみで終了（猶予時間内にモデル保存や評価は行わない）
+    if signal_checkpoint_callback.stopped_by_signal:
+        logger.info("*** Training stopped by signal, checkpoint saved ***")
+        return
+    metrics = train_result.metrics
+    metrics["train_samples"] = len(raw_datasets["train"])
+    trainer.log_metrics("train", metrics)
+    trainer.save_metrics("train", metrics)
+    trainer.save_state()
+
+    logger.info("*** Training complete ***")
+
+    ##################################
+    # Save model and create model card
+    ##################################
+    logger.info("*** Save model ***")
+    trainer.save_model(training_args.output_dir)
+    logger.info(f"Model saved to {training_args.output_dir}")
+
+    # Save everything else on main process
+    kwargs = {
+        "finetuned_from": model_args.model_name_or_path,
+        "dataset": list(data_args.dataset_mixer.keys()),
+        "dataset_tags": list(data_args.dataset_mixer.keys()),
+        "tags": ["alignment-handbook"],
+    }
+    if trainer.accelerator.is_main_process:
+        trainer.create_model_card(**kwargs)
+        # Restore k,v cache for fast inference
+        trainer.model.config.use_cache = True
+        trainer.model.config.save_pretrained(training_args.output_dir)
+
+    ##########
+    # Evaluate
+    ##########
+    if training_args.do_eval:
+        logger.info("*** Evaluate ***")
+        metrics = trainer.evaluate()
+        metrics["eval_samples"] = len(raw_datasets["test"])
+        trainer.log_metrics("eval", metrics)
+        trainer.save_metrics("eval", metrics)
+
+    if training_args.push_to_hub is True:
+        logger.info("Pushing to hub...")
+        trainer.push_to_hub(**kwargs)
+
+    logger.info("*** Training complete! ***")
 
 
 if __name__ == "__main__":
@@ -35,6 +35,8 @@ class SimPOConfig(TrainingArguments):
             The padding value if it is different to the tokenizer's pad_token_id.
         truncation_mode (`str`, defaults to `keep_end`):
             The truncation mode to use, either `keep_end` or `keep_start`. This argument is required if you want to use the default data collator.
+        pad_to_max_length (`bool`, defaults to `False`):
+            Whether to pad the concatenated chosen/rejected inputs to `max_length` instead of the longest sequence in the batch. Keeps input shapes static, e.g. to avoid recompiles with `torch.compile`.
         generate_during_eval (`bool`, defaults to `False`):
             Whether to sample and log generations during evaluation step.
         is_encoder_decoder (`Optional[bool]`, `optional`, defaults to `None`):
@@ -62,6 +64,7 @@ class SimPOConfig(TrainingArguments):
     label_pad_token_id: int = -100
     padding_value: int = None
     truncation_mode: str = "keep_end"
+    pad_to_max_length: bool = False
     generate_during_eval: bool = False
     is_encoder_decoder: Optional[bool] = None
 
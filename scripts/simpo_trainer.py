@@ -247,6 +247,7 @@ class SimPOTrainer(Trainer):
         self.padding_value = args.padding_value if args.padding_value is not None else tokenizer.pad_token_id
         self.max_prompt_length = max_prompt_length
         self.truncation_mode = args.truncation_mode
+        self.pad_to_max_length = args.pad_to_max_length
         self.max_target_length = max_target_length
         self.tokenizer = tokenizer
 
@@ -266,10 +267,26 @@ class SimPOTrainer(Trainer):
         # Compute that only on the main process for faster data processing.
         # see: https://github.com/huggingface/trl/pull/1255
         with PartialState().local_main_process_first():
-            # tokenize the dataset
-            train_dataset = train_dataset.map(self.tokenize_row, num_proc=args.dataset_num_proc)
-            if eval_dataset is not None:
-                eval_dataset = eval_dataset.map(self.tokenize_row, num_proc=args.dataset_num_proc)
+            # tokenize the dataset, in batches for fast tokenizers so that the Rust backend can encode them in parallel
+            if tokenizer.is_fast and not self.is_encoder_decoder:
+                map_kwargs = {"function": self.tokenize_batch, "batched": True}
+            else:
+                map_kwargs = {"function": self.tokenize_row}
+            # datasets that already hold the tokenized columns (e.g. a saved, previously tokenized dataset) are kept as is
+            if "prompt_input_ids" not in train_dataset.column_names:
+                train_dataset = train_dataset.map(**map_kwargs, num_proc=args.dataset_num_proc)
+            if eval_dataset is not None and "prompt_input_ids" not in eval_dataset.column_names:
+                eval_dataset = eval_dataset.map(**map_kwargs, num_proc=args.dataset_num_proc)
+            # the `LengthGroupedSampler` used with `group_by_length` needs the per-row lengths
+            if args.group_by_length and args.length_column_name not in train_dataset.column_names:
+                length_key = "labels" if self.is_encoder_decoder else "input_ids"
+                train_dataset = train_dataset.map(
+                    self.compute_lengths,
+                    batched=True,
+                    input_columns=[f"chosen_{length_key}", f"rejected_{length_key}"],
+                    fn_kwargs={"length_column_name": args.length_column_name},
+                    num_proc=args.dataset_num_proc,
+                )
 
         super().__init__(
             model=model,
@@ -294,16 +311,20 @@ class SimPOTrainer(Trainer):
                 "Your `Trainer` does not have an `accelerator` object. Consider upgrading `transformers`."
             )
 
-    def build_tokenized_answer(self, prompt, answer):
+    def build_tokenized_answer(self, prompt, answer, full_tokenized=None, prompt_input_ids=None):
         """
         Llama tokenizer does satisfy `enc(a + b) = enc(a) + enc(b)`.
         It does ensure `enc(a + b) = enc(a) + enc(a + b)[len(enc(a)):]`.
         Reference:
             https://github.com/EleutherAI/lm-evaluation-harness/pull/531#issuecomment-1595586257
+
+        `full_tokenized` and `prompt_input_ids` can be passed if `prompt + answer` and `prompt` have already been tokenized.
         """
 
-        full_tokenized = self.tokenizer(prompt + answer, add_special_tokens=False)
-        prompt_input_ids = self.tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        if full_tokenized is None:
+            full_tokenized = self.tokenizer(prompt + answer, add_special_tokens=False)
+        if prompt_input_ids is None:
+            prompt_input_ids = self.tokenizer(prompt, add_special_tokens=False)["input_ids"]
 
         answer_input_ids = full_tokenized["input_ids"][len(prompt_input_ids) :]
         answer_attention_mask = full_tokenized["attention_mask"][len(prompt_input_ids) :]
@@ -344,7 +365,37 @@ class SimPOTrainer(Trainer):
             attention_mask=answer_attention_mask,
         )
 
-    def tokenize_row(self, feature, model: Optional[Union[PreTrainedModel, nn.Module]] = None) -> Dict:
+    def tokenize_batch(self, features: Dict[str, List]) -> Dict[str, List]:
+        """Tokenize a batch of rows from a SimPO specific dataset, see `tokenize_row`.
+
+        The prompts and the prompt + chosen/rejected texts of the whole batch are each encoded with a single
+        tokenizer call, which lets fast tokenizers encode them in parallel. Only supported for decoder-only models.
+        """
+        prompts, chosens, rejecteds = features["prompt"], features["chosen"], features["rejected"]
+        prompt_tokens = self.tokenizer(prompts, add_special_tokens=False)
+        chosen_tokens = self.tokenizer([p + c for p, c in zip(prompts, chosens)], add_special_tokens=False)
+        rejected_tokens = self.tokenizer([p + r for p, r in zip(prompts, rejecteds)], add_special_tokens=False)
+
+        batch = defaultdict(list)
+        for i, (prompt, chosen, rejected) in enumerate(zip(prompts, chosens, rejecteds)):
+            row = self.tokenize_row(
+                {"prompt": prompt, "chosen": chosen, "rejected": rejected},
+                pretokenized={
+                    "prompt": {k: v[i] for k, v in prompt_tokens.items()},
+                    "chosen": {k: v[i] for k, v in chosen_tokens.items()},
+                    "rejected": {k: v[i] for k, v in rejected_tokens.items()},
+                },
+            )
+            for k, v in row.items():
+                batch[k].append(v)
+        return dict(batch)
+
+    def tokenize_row(
+        self,
+        feature,
+        model: Optional[Union[PreTrainedModel, nn.Module]] = None,
+        pretokenized: Optional[Dict[str, Dict[str, List[int]]]] = None,
+    ) -> Dict:
         """Tokenize a single row from a SimPO specific dataset.
 
         At this stage, we don't convert to PyTorch tensors yet; we just handle the truncation
@@ -354,6 +405,9 @@ class SimPOTrainer(Trainer):
         We also create the labels for the chosen/rejected responses, which are of length equal to
             the sum of the length of the prompt and the chosen/rejected response, with
             label_pad_token_id  for the prompt tokens.
+
+        `pretokenized` optionally holds the encodings of `prompt`, `prompt + chosen` and `prompt + rejected`
+            (keyed by "prompt", "chosen" and "rejected"), as computed by `tokenize_batch`.
         """
         batch = {}
         prompt = feature["prompt"]
@@ -368,16 +422,29 @@ class SimPOTrainer(Trainer):
 
             if not isinstance(prompt, str):
                 raise ValueError(f"prompt should be an str but got {type(prompt)}")
-            prompt_tokens = self.tokenizer(prompt, add_special_tokens=False)
+            if pretokenized is None:
+                prompt_tokens = self.tokenizer(prompt, add_special_tokens=False)
+            else:
+                prompt_tokens = pretokenized["prompt"]
             prompt_tokens = {f"prompt_{k}": v for k, v in prompt_tokens.items()}
 
             if not isinstance(chosen, str):
                 raise ValueError(f"chosen should be an str but got {type(chosen)}")
-            chosen_tokens = self.build_tokenized_answer(prompt, chosen)
+            chosen_tokens = self.build_tokenized_answer(
+                prompt,
+                chosen,
+                full_tokenized=pretokenized["chosen"] if pretokenized is not None else None,
+                prompt_input_ids=prompt_tokens["prompt_input_ids"],
+            )
 
             if not isinstance(rejected, str):
                 raise ValueError(f"rejected should be an str but got {type(rejected)}")
-            rejected_tokens = self.build_tokenized_answer(prompt, rejected)
+            rejected_tokens = self.build_tokenized_answer(
+                prompt,
+                rejected,
+                full_tokenized=pretokenized["rejected"] if pretokenized is not None else None,
+                prompt_input_ids=prompt_tokens["prompt_input_ids"],
+            )
 
             # Last prompt token might get merged by tokenizer and
             # it should not be included for generation if that happens
@@ -495,6 +562,17 @@ class SimPOTrainer(Trainer):
 
         return batch
 
+    @staticmethod
+    def compute_lengths(
+        chosen_tokens: List[List[int]], rejected_tokens: List[List[int]], length_column_name: str = "length"
+    ) -> Dict[str, List[int]]:
+        """Compute the length of each row as the longer of its tokenized chosen/rejected sequences.
+
+        Since chosen and rejected are padded to a common length in `concatenated_inputs`, this is the
+        sequence length the row contributes to a batch.
+        """
+        return {length_column_name: [max(len(c), len(r)) for c, r in zip(chosen_tokens, rejected_tokens)]}
+
     @staticmethod
     def concatenated_inputs(
         batch: Dict[str, Union[List, torch.LongTensor]],
@@ -502,6 +580,7 @@ class SimPOTrainer(Trainer):
         label_pad_token_id: int = -100,
         padding_value: int = 0,
         device: Optional[torch.device] = None,
+        max_length: Optional[int] = None,
     ) -> Dict[str, torch.LongTensor]:
         """Concatenate the chosen and rejected inputs into a single tensor.
 
@@ -511,16 +590,18 @@ class SimPOTrainer(Trainer):
             label_pad_token_id: The label pad token id.
             padding_value: The padding value to use for the concatenated inputs_ids.
             device: The device for the concatenated inputs.
+            max_length: If given, pad the concatenated inputs to this length instead of the longest sequence in the batch.
 
         Returns:
             A dictionary containing the concatenated inputs under the key 'concatenated_input_ids'.
         """
         concatenated_batch = {}
 
-        if is_encoder_decoder:
-            max_length = max(batch["chosen_labels"].shape[1], batch["rejected_labels"].shape[1])
-        else:
-            max_length = max(batch["chosen_input_ids"].shape[1], batch["rejected_input_ids"].shape[1])
+        if max_length is None:
+            if is_encoder_decoder:
+                max_length = max(batch["chosen_labels"].shape[1], batch["rejected_labels"].shape[1])
+            else:
+                max_length = max(batch["chosen_input_ids"].shape[1], batch["rejected_input_ids"].shape[1])
 
         for k in batch:
             if k.startswith("chosen") and isinstance(batch[k], torch.Tensor):
@@ -607,6 +688,7 @@ class SimPOTrainer(Trainer):
             label_pad_token_id=self.label_pad_token_id,
             padding_value=self.padding_value,
             device=self.accelerator.device,
+            max_length=self.max_length if self.pad_to_max_length else None,
         )
         len_chosen = batch["chosen_labels"].shape[0]
 